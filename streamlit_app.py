@@ -1,10 +1,19 @@
 import json
+import logging
+import re
+import threading
 import streamlit as st
-import pypdfium2 as pdfium
-from typing import Any, Dict, List
-from utils.snowflake_utils import session, root
-from utils.llm_utils import get_invoice_answer, refine_question
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from snowflake.snowpark.exceptions import SnowparkSQLException
+from typing import Any, Callable, Dict, List, Optional
+from utils.snowflake_utils import session, current_database, current_schema, render_pdf_thumbnail
+from utils.llm_utils import get_invoice_answer_stream, has_context_reference, needs_refinement, refine_question
 from utils.search_utils import query_cortex_search_service
+from utils.cache_utils import embed_question, lookup_cached_answer, store_cached_answer
+
+
+logger = logging.getLogger(__name__)
 
 
 # === Configuration Constants ===
@@ -17,23 +26,50 @@ REFINE_MAX_TOKENS = 500
 SUMMARY_TEMPERATURE = 0.0
 SUMMARY_MAX_TOKENS = 750
 
+# Phrasing words the refiner adds when turning input into a question; ignored when
+# deciding whether refinement changed what the search should look for
+REFINE_FILLER_WORDS = {
+    "how", "can", "could", "do", "does", "i", "what", "why", "is", "are", "should",
+    "the", "a", "an", "to", "my", "fix", "resolve", "solve", "troubleshoot",
+}
+
 
 # === Helper Functions ===
 
+def _describe_search_column(name: str) -> Optional[str]:
+    """
+    Return the search column of a single Cortex search service.
+    """
+    
+    desc = session.sql(f"DESC CORTEX SEARCH SERVICE {name}").collect()
+    return desc[0]["search_column"] if desc else None
+
+
 @st.cache_data(show_spinner=False)
 def load_service_metadata() -> List[Dict[str, Any]]:
     """
     Fetch and cache metadata (names and search columns) for all Cortex search services.
     """
     
-    rows = session.sql("SHOW CORTEX SEARCH SERVICES").collect()
-    metas: List[Dict[str, Any]] = []
-    for s in rows:
-        name = s["name"]
-        desc = session.sql(f"DESC CORTEX SEARCH SERVICE {name}").collect()
-        search_col = desc[0]["search_column"] if desc else None
-        metas.append({"name": name, "search_column": search_col})
-    return metas
+    # Single round-trip through the information schema view
+    try:
+        rows = session.sql(
+            "SELECT service_name, search_column "
+            "FROM INFORMATION_SCHEMA.CORTEX_SEARCH_SERVICES "
+            "WHERE service_schema = CURRENT_SCHEMA() "
+            "ORDER BY service_name"
+        ).collect()
+    except SnowparkSQLException as e:
+        logger.warning("CORTEX_SEARCH_SERVICES view query failed, falling back to SHOW/DESC: %s", e)
+        rows = []
+    if rows:
+        return [{"name": r["SERVICE_NAME"], "search_column": r["SEARCH_COLUMN"]} for r in rows]
+
+    # Fallback (view unavailable or empty): list the services, then describe them concurrently
+    names = [s["name"] for s in session.sql("SHOW CORTEX SEARCH SERVICES").collect()]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        search_cols = list(pool.map(_describe_search_column, names))
+    return [{"name": n, "search_column": c} for n, c in zip(names, search_cols)]
 
 
 def load_config() -> Dict[str, Any]:
@@ -44,6 +80,10 @@ def load_config() -> Dict[str, Any]:
     # Load service metadata once
     if "service_metadata" not in st.session_state:
         st.session_state.service_metadata = load_service_metadata()
+    if "service_meta_map" not in st.session_state:
+        st.session_state.service_meta_map = {
+            m["name"]: m["search_column"] for m in st.session_state.service_metadata
+        }
 
     # Search configuration UI
     with st.sidebar.expander("🔍 Search Configuration", expanded=False):
@@ -52,6 +92,7 @@ def load_config() -> Dict[str, Any]:
         num_retrieved_chunks = st.number_input(
             "Chunks to retrieve:", min_value=1, max_value=10, value=3
         )
+        use_reranker = st.checkbox("Use reranker", value=False)
 
     # Chat and LLM settings UI
     with st.sidebar.expander("💬 Chat Settings", expanded=False):
@@ -69,6 +110,7 @@ def load_config() -> Dict[str, Any]:
     return {
         "selected_service": selected_service,
         "num_retrieved_chunks": num_retrieved_chunks,
+        "use_reranker": use_reranker,
         "num_chat_messages": num_chat_messages,
         "refine_temperature": REFINE_TEMPERATURE,
         "refine_max_tokens": REFINE_MAX_TOKENS,
@@ -84,22 +126,129 @@ def init_messages() -> None:
     
     if st.session_state.get("clear_conversation"):
         st.session_state.messages = []
+        st.session_state.pop("last_search_results", None)
         st.session_state.clear_conversation = False
         
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
 
-def display_pdf_page(key: str):
+def _run_with_ctx(ctx, fn: Callable, *args, **kwargs):
+    """
+    Run a function in a worker thread with the Streamlit script context attached,
+    so it can read session state and emit UI messages.
+    """
+    
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return fn(*args, **kwargs)
+
+
+def _keywords(text: str) -> set:
     """
-    Render the first page of the PDF in session state.
+    Lowercase content words of a string, without refiner phrasing words.
     """
     
-    pdf = st.session_state[key]
-    page = pdf.get_page(0)
-    bitmap = page.render(scale=2)
-    st.image(bitmap.to_pil(), use_container_width=True)
-    page.close()
+    return set(re.findall(r"\w+", text.lower())) - REFINE_FILLER_WORDS
+
+
+def refine_and_retrieve(user_q: str, config: Dict[str, Any], model: str):
+    """
+    Resolve the question to search for, then search and check the semantic answer
+    cache concurrently. Returns the question, context chunks, the cached entry (if any)
+    and the question embedding.
+
+    Inputs without back-references run a speculative search on the raw question
+    concurrently with refinement; it is reused when refinement only rephrased the
+    input (no new keywords).
+    """
+    
+    search_kwargs = {
+        "service": config['selected_service'],
+        "limit": config['num_retrieved_chunks'],
+        "search_columns": st.session_state.service_meta_map,
+        "use_reranker": config['use_reranker'],
+    }
+    refine_kwargs = {
+        "raw_question": user_q,
+        "model_name": model,
+        "temperature": config['refine_temperature'],
+        "max_tokens": config['refine_max_tokens'],
+    }
+    ctx = get_script_run_ctx()
+    # Per-call pool: its threads (and the attached script context) exit with the tasks
+    pool = ThreadPoolExecutor(max_workers=2)
+    search_future = None
+    refine_needed = needs_refinement(user_q)
+    if not refine_needed:
+        rewritten_q = user_q
+    elif has_context_reference(user_q):
+        # Back-references get rewritten with new context, so a raw search would be discarded
+        rewritten_q = refine_question(**refine_kwargs)
+    else:
+        refine_future = pool.submit(_run_with_ctx, ctx, refine_question, **refine_kwargs)
+        search_future = pool.submit(
+            _run_with_ctx, ctx, query_cortex_search_service, user_q, **search_kwargs
+        )
+        rewritten_q = refine_future.result()
+        if rewritten_q != user_q and not _keywords(rewritten_q) <= _keywords(user_q):
+            search_future = None
+
+    # Search while the question is embedded for the cache lookup; the (TTL-cached)
+    # search result is simply discarded on a cache hit
+    if search_future is None:
+        search_future = pool.submit(
+            _run_with_ctx, ctx, query_cortex_search_service, rewritten_q, **search_kwargs
+        )
+    pool.shutdown(wait=False)
+
+    # Only self-contained questions go through the shared cache (no vector means no
+    # lookup and no store): skip back-references, and inputs the refiner should have
+    # rewritten but returned unchanged (e.g. because refinement failed)
+    cacheable = not has_context_reference(rewritten_q) and not (refine_needed and rewritten_q == user_q)
+    q_vec = embed_question(rewritten_q) if cacheable else None
+    cached = lookup_cached_answer(
+        q_vec, config['selected_service'], config['num_retrieved_chunks'], config['use_reranker']
+    )
+    if cached:
+        return rewritten_q, cached["chunks"], cached, q_vec
+    return rewritten_q, search_future.result(), None, q_vec
+
+
+def display_pdf_page(stage_ref: str):
+    """
+    Render the first page of the staged PDF as a compressed thumbnail.
+    """
+    
+    st.image(render_pdf_thumbnail(stage_ref), use_container_width=True)
+
+
+def render_search_results(chunks: List[Dict[str, Any]], turn: int, previews_enabled: bool = True) -> None:
+    """
+    Render search results as expanders; PDF previews are only fetched and rendered on demand.
+    Preview toggles can be disabled while an answer is still being generated.
+    """
+    
+    st.markdown("###### 🔍 Search Results")
+    if not chunks:
+        st.info("No search results found.")
+        return
+
+    for idx, c in enumerate(chunks, start=1):
+        with st.expander(f"Result {idx}: {c['file']}"):
+            
+            st.write(
+                f"**Last Updated:** {c['last_updated']}  \n"
+                f"**Applies To:** {c['applies_to']}  \n"
+            )
+            
+            # Load and display the first page only once the preview is requested
+            if st.toggle(
+                "Show document preview",
+                key=f"preview_{turn}_{idx}",
+                disabled=not previews_enabled,
+            ):
+                stage_ref = f"@{current_database}.{current_schema}.DOC_AI_STAGE/{c['file']}"
+                display_pdf_page(stage_ref)
 
 
 def main_chat_loop(config: Dict[str, Any], model: str) -> None:
@@ -112,6 +261,8 @@ def main_chat_loop(config: Dict[str, Any], model: str) -> None:
     for msg in st.session_state.messages:
         with st.chat_message(msg['role']):
             st.markdown(msg['content'])
+            if msg.get('refined'):
+                st.markdown(f"**Refined question:** {msg['refined']}")
 
     # Accept user input
     if user_q := st.chat_input("Type your question here..."):
@@ -119,22 +270,8 @@ def main_chat_loop(config: Dict[str, Any], model: str) -> None:
         # Save raw input
         st.session_state.messages.append({"role": "user", "content": user_q})
 
-        # Refine the question for better LLM performance
-        rewritten_q = refine_question(
-            raw_question=user_q,
-            model_name=model,
-            num_history=config['num_chat_messages'],
-            temperature=config['refine_temperature'],
-            max_tokens=config['refine_max_tokens']
-        )
-
-        # Retrieve context chunks via Cortex Search
-        chunks = query_cortex_search_service(
-            rewritten_q,
-            service=config['selected_service'],
-            limit=config['num_retrieved_chunks'],
-            metadata=st.session_state.service_metadata,
-        )
+        # Refine the question, then reuse a cached answer or retrieve context via Cortex Search
+        rewritten_q, chunks, cached, q_vec = refine_and_retrieve(user_q, config, model)
         st.session_state.last_context_json = json.dumps(chunks)
 
         # Display user message and optional refinement
@@ -142,48 +279,60 @@ def main_chat_loop(config: Dict[str, Any], model: str) -> None:
             st.markdown(user_q)
             if rewritten_q != user_q:
                 st.markdown(f"**Refined question:** {rewritten_q}")
+                # Kept on the message so the refinement survives the rerun below
+                st.session_state.messages[-1]["refined"] = rewritten_q
 
-        # Generate and display assistant response
-        with st.chat_message("assistant"):
-            with st.spinner("Generating response…"):
-                answer = get_invoice_answer(
-                    question=rewritten_q,
-                    context_chunks=chunks,
-                    model_name=model,
-                    max_tokens=config['summary_max_tokens'],
-                    temperature=config['summary_temperature'],
-                    chat_history=st.session_state.messages[-config['num_chat_messages']:]
-                )
-
-                # For debugging: Uncomment if the text format looks weird
-                # st.sidebar.markdown("#### Raw LLM response")
-                # st.sidebar.code(answer, language="text")
-                
-                st.session_state.messages.append({"role": "assistant", "content": answer})
-                st.markdown(answer)
+        # Reserve the assistant slot above the sources, then render sources
+        # immediately so they can be read while the answer streams in
+        answer_slot = st.chat_message("assistant")
 
         # Show raw search results for transparency
-        st.markdown("###### 🔍 Search Results")
-        if chunks:
-            for idx, c in enumerate(chunks, start=1):
-                with st.expander(f"Result {idx}: {c['file']}"):
-                    
-                    st.write(
-                        f"**Last Updated:** {c['last_updated']}  \n"
-                        f"**Applies To:** {c['applies_to']}  \n"
-                    )
-                    
-                    # Load PDF once per file
-                    key = f"pdf_doc_{c['file']}"
-                    if key not in st.session_state:
-                        stage_ref = f"@{session.get_current_database()}.{session.get_current_schema()}.DOC_AI_STAGE/{c['file']}"
-                        raw_bytes = session.file.get_stream(stage_ref).read()
-                        st.session_state[key] = pdfium.PdfDocument(raw_bytes)
-                    
-                    # Display only first page
-                    display_pdf_page(key)
-        else:
-            st.info("No search results found.")
+        st.session_state.search_turn = st.session_state.get("search_turn", 0) + 1
+        st.session_state.last_search_results = chunks
+        # Toggling a preview reruns the script, which would abort the answer mid-stream,
+        # so previews stay disabled until the answer is stored
+        render_search_results(chunks, st.session_state.search_turn, previews_enabled=False)
+
+        # Generate and display assistant response
+        with answer_slot:
+            if cached:
+                answer = cached["answer"]
+                st.markdown(answer)
+            else:
+                # Stream tokens as they arrive; write_stream returns the full text
+                try:
+                    answer = st.write_stream(get_invoice_answer_stream(
+                        question=rewritten_q,
+                        context_chunks=chunks,
+                        model_name=model,
+                        max_tokens=config['summary_max_tokens'],
+                        temperature=config['summary_temperature'],
+                        # Earlier turns only; the current question is sent separately
+                        chat_history=st.session_state.messages[-(config['num_chat_messages'] + 1):-1]
+                    ))
+                except Exception as e:
+                    answer = f"Error: {e}"
+                    st.markdown(answer)
+                else:
+                    # Only answers that streamed to completion are shared via the cache
+                    if chunks:
+                        store_cached_answer(
+                            q_vec, config['selected_service'], config['num_retrieved_chunks'],
+                            config['use_reranker'], answer, chunks
+                        )
+
+            # For debugging: Uncomment if the text format looks weird
+            # st.sidebar.markdown("#### Raw LLM response")
+            # st.sidebar.code(answer, language="text")
+            
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+
+        # Redraw from history with the preview toggles enabled
+        st.rerun()
+
+    # Keep the latest results visible across reruns (e.g. preview toggles)
+    elif "last_search_results" in st.session_state:
+        render_search_results(st.session_state.last_search_results, st.session_state.search_turn)
 
 
 # === Streamlit App ===
@@ -0,0 +1,80 @@
+import logging
+import threading
+import numpy as np
+import streamlit as st
+from typing import Any, Dict, List, Optional
+from snowflake.cortex import EmbedText768
+from utils.snowflake_utils import session
+
+
+logger = logging.getLogger(__name__)
+
+EMBED_MODEL = "e5-base-v2"
+# e5 models expect a role prefix; without it similarity scores cluster high
+EMBED_QUERY_PREFIX = "query: "
+SIMILARITY_THRESHOLD = 0.92
+MAX_CACHE_ENTRIES = 1024
+
+
+@st.cache_resource
+def _get_answer_cache() -> Dict[str, Any]:
+    """
+    Create the process-wide semantic answer cache shared by all sessions.
+    """
+
+    return {
+        "lock": threading.Lock(),
+        "vectors": np.empty((0, 768), dtype=np.float32),
+        "entries": [],
+    }
+
+
+def embed_question(question: str) -> Optional[np.ndarray]:
+    """
+    Embed a question and return it as a unit-length vector, or None on failure.
+    """
+
+    try:
+        vec = np.asarray(EmbedText768(EMBED_MODEL, EMBED_QUERY_PREFIX + question, session=session), dtype=np.float32)
+    except Exception as e:
+        logger.warning("Question embedding failed, skipping the answer cache: %s", e)
+        return None
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else None
+
+
+def lookup_cached_answer(vec: Optional[np.ndarray], service: str, limit: int, use_reranker: bool) -> Optional[Dict[str, Any]]:
+    """
+    Return the cached answer and chunks for the most similar question retrieved with
+    the same search settings, if its cosine similarity meets the threshold.
+    """
+
+    if vec is None:
+        return None
+
+    cache = _get_answer_cache()
+    with cache["lock"]:
+        if not cache["entries"]:
+            return None
+        scores = cache["vectors"] @ vec
+        scope = (service, limit, use_reranker)
+        scores[[e["scope"] != scope for e in cache["entries"]]] = -1.0
+        best = int(np.argmax(scores))
+        if scores[best] < SIMILARITY_THRESHOLD:
+            return None
+        return cache["entries"][best]
+
+
+def store_cached_answer(vec: Optional[np.ndarray], service: str, limit: int, use_reranker: bool, answer: str, chunks: List[Dict[str, Any]]) -> None:
+    """
+    Add an answer and its context chunks to the semantic cache, evicting the oldest entry when full.
+    """
+
+    if vec is None:
+        return
+
+    cache = _get_answer_cache()
+    with cache["lock"]:
+        cache["vectors"] = np.vstack([cache["vectors"], vec])[-MAX_CACHE_ENTRIES:]
+        entry = {"scope": (service, limit, use_reranker), "answer": answer, "chunks": chunks}
+        cache["entries"] = (cache["entries"] + [entry])[-MAX_CACHE_ENTRIES:]
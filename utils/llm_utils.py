@@ -1,15 +1,21 @@
-import json
+import re
+import orjson
+from typing import Iterator
 import streamlit as st
 from snowflake.cortex import Complete, CompleteOptions
 from utils.snowflake_utils import session
 
 
-def _build_refine_prompt(raw_question: str, chat_history: str) -> str:
-    """
-    Construct a prompt for refining user questions using chat history.
-    """
-    
-    system = """
+# Prompt history bounds: refiner sees only the previous exchange, each message capped
+REFINE_HISTORY_MESSAGES = 2
+HISTORY_MAX_CHARS = 400
+
+# Words that usually point back to earlier turns and need history to resolve
+_CONTEXT_REFERENCE_RE = re.compile(r"\b(it|this|that|these|they|them|those)\b", re.IGNORECASE)
+
+
+# System prompts are module constants so every request shares a byte-identical prefix
+_REFINE_SYSTEM = """
     You are a query refiner.
     
     Given the recent chat history and a user input, produce a clear, focused question that preserves the user's intent.
@@ -19,9 +25,41 @@ def _build_refine_prompt(raw_question: str, chat_history: str) -> str:
     
     Output ONLY the rewritten question, ending with a question mark. — no extra comments and no follow-up questions.
     """
+
+_INVOICE_SYSTEM = """
+    You are an invoice assistant.
+    Answer the user's question using ONLY the data in the JSON context below. Be concise and factual.  
+    Output must be valid Markdown.
+    
+    When you need to return multiple discrete pieces of information, format it as a Markdown list:
+    - Always put a blank line before and after the list.
+    - Start each bullet with `- ` (dash + space).
+    
+    Otherwise, respond in normal prose.
+    
+    If you cannot answer from the context, say “I don't know.”
+    """
+
+
+def _serialize_history(messages: list) -> str:
+    """
+    Serialize chat messages to JSON, truncating each message.
+    """
+    
+    return orjson.dumps([
+        {"role": m["role"], "content": m["content"][:HISTORY_MAX_CHARS]}
+        for m in messages
+    ]).decode()
+
+
+def _build_refine_prompt(raw_question: str, chat_history: str) -> str:
+    """
+    Construct a prompt for refining user questions using chat history.
+    """
+    
     return "\n".join([
         "[SYSTEM]",
-        system,
+        _REFINE_SYSTEM,
         "[/SYSTEM]",
         "[HISTORY]",
         chat_history,
@@ -32,16 +70,40 @@ def _build_refine_prompt(raw_question: str, chat_history: str) -> str:
     ])
 
 
-def refine_question(raw_question: str, model_name: str, num_history: int, temperature: float, max_tokens: int) -> str:
+def has_context_reference(question: str) -> bool:
     """
-    Optionally rewrite the user's question for clarity and focus.
+    Whether the question contains a pronoun that refers back to earlier turns.
+    """
+    
+    return bool(_CONTEXT_REFERENCE_RE.search(question))
+
+
+def needs_refinement(raw_question: str) -> bool:
+    """
+    Whether the question should go through the refiner; self-contained questions
+    and first turns are used as-is.
     """
     
     if len(st.session_state.messages) < 2:
+        return False
+    return not (
+        raw_question.rstrip().endswith("?")
+        and len(raw_question.split()) > 3
+        and not has_context_reference(raw_question)
+    )
+
+
+def refine_question(raw_question: str, model_name: str, temperature: float, max_tokens: int) -> str:
+    """
+    Optionally rewrite the user's question for clarity and focus.
+    """
+    
+    if not needs_refinement(raw_question):
         return raw_question
 
-    hist = st.session_state.messages[-num_history:]
-    hist_json = json.dumps(hist)
+    # The last message is the question being refined; send only the exchange before it
+    hist = st.session_state.messages[-(REFINE_HISTORY_MESSAGES + 1):-1]
+    hist_json = _serialize_history(hist)
     prompt = _build_refine_prompt(raw_question, hist_json)
     opts = CompleteOptions({
         "temperature": temperature,
@@ -64,41 +126,33 @@ def _build_invoice_prompt(context_json: str, question: str, chat_history: str =
     Build a structured prompt for answering invoice questions using provided context.
     """
     
-    system = """
-    You are an invoice assistant.
-    Answer the user's question using ONLY the data in the JSON context below. Be concise and factual.  
-    Output must be valid Markdown.
-    
-    When you need to return multiple discrete pieces of information, format it as a Markdown list:
-    - Always put a blank line before and after the list.
-    - Start each bullet with `- ` (dash + space).
-    
-    Otherwise, respond in normal prose.
-    
-    If you cannot answer from the context, say “I don't know.”
-    """
-    parts = ["[SYSTEM]", system, "[/SYSTEM]", f"[CONTEXT]\n{context_json}\n[/CONTEXT]"]
+    # Constant system block first; history (a sliding window of earlier turns) comes next,
+    # then the per-turn context and question
+    parts = ["[SYSTEM]", _INVOICE_SYSTEM, "[/SYSTEM]"]
     if chat_history:
         parts += [f"[HISTORY]\n{chat_history}\n[/HISTORY]"]
-    parts += ["QUESTION:", question, "ANSWER:"]
+    parts += [f"[CONTEXT]\n{context_json}\n[/CONTEXT]", "QUESTION:", question, "ANSWER:"]
     return "\n".join(parts)
 
 
-def get_invoice_answer(question: str, context_chunks: list, model_name: str, max_tokens: int, temperature: float, chat_history: list = None) -> str:
+def get_invoice_answer_stream(question: str, context_chunks: list, model_name: str, max_tokens: int, temperature: float, chat_history: list = None) -> Iterator[str]:
     """
-    Call the LLM to generate an answer for the invoice question.
+    Call the LLM to generate an answer for the invoice question, streaming the text.
 
-    Constructs the prompt, invokes the completion API, and returns text.
+    Constructs the prompt, invokes the completion API with streaming enabled,
+    and yields text fragments as they arrive. Errors propagate to the caller
+    so a partial answer is never mistaken for a complete one.
     """
     
-    context_json = json.dumps(context_chunks)
-    history_json = json.dumps(chat_history) if chat_history else None
+    context_json = orjson.dumps(context_chunks).decode()
+    # Only earlier user turns are needed to disambiguate the question
+    user_history = [m for m in chat_history or [] if m["role"] == "user"]
+    history_json = _serialize_history(user_history) if user_history else None
     prompt = _build_invoice_prompt(context_json, question, history_json)
     options = CompleteOptions({
         "max_tokens": max_tokens,
         "temperature": temperature
     })
-    try:
-        return Complete(model_name, prompt, options=options, session=session)
-    except Exception as e:
-        return f"Error: {e}"
\ No newline at end of file
+    for fragment in Complete(model_name, prompt, options=options, session=session, stream=True):
+        if fragment:
+            yield fragment
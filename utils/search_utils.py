@@ -1,54 +1,81 @@
 import streamlit as st
-from typing import List, Dict, Any
-from utils.snowflake_utils import session, root
+from typing import List, Dict, Any, Optional, Tuple
+from utils.snowflake_utils import current_database, current_schema, get_search_service
 
 
-def query_cortex_search_service(query: str, service: str, limit: int, metadata: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+# Result field -> service column; "chunk" maps to the service's own search column
+RESULT_COLUMNS = {
+    "file": "FILE_NAME",
+    "chunk": None,
+    "title": "TITLE_VALUE",
+    "last_updated": "LAST_UPDATED_VALUE",
+    "applies_to": "APPLIES_TO_VALUE",
+    "file_url": "SNOWFLAKE_FILE_URL",
+}
+
+
+def _result_columns(search_col: str) -> Dict[str, str]:
     """
-    Execute a search against a specified Cortex Search service and format results.
+    Resolve the result field to service column mapping for a given search column.
+    """
+    
+    return {field: col or search_col for field, col in RESULT_COLUMNS.items()}
+
+
+def _resolve_search_column(service: str, search_columns: Dict[str, str]) -> Optional[str]:
+    """
+    Validate the selected service and return its search column, or None if unusable.
     """
     
     if not service:
         st.warning("Please select a search service.")
-        return []
+        return None
 
-    idx = next((i for i, m in enumerate(metadata) if m["name"] == service), None)
-    if idx is None or not metadata[idx]["search_column"]:
+    search_col = search_columns.get(service)
+    if not search_col:
         st.error(f"Invalid service metadata for '{service}'.")
-        return []
+        return None
+    return search_col
+
 
-    search_col = metadata[idx]["search_column"]
-    svc = (
-        root.databases[session.get_current_database()]
-            .schemas[session.get_current_schema()]
-            .cortex_search_services[service]
+@st.cache_data(ttl=300, max_entries=512, show_spinner=False)
+def _cached_search(query: str, service: str, limit: int, columns: Tuple[str, ...], use_reranker: bool) -> Tuple[Dict[str, Any], ...]:
+    """
+    Run the Cortex Search request, caching raw records for identical requests.
+    Errors propagate so failures are never cached.
+    """
+    
+    svc = get_search_service(current_database, current_schema, service)
+    # Reranking noticeably increases query latency, so it is opt-in
+    extra_args = {} if use_reranker else {"scoring_config": {"reranker": "none"}}
+    resp = svc.search(
+        query=query,
+        columns=list(columns),
+        limit=limit,
+        **extra_args
     )
+    return tuple(resp.results)
+
+
+def query_cortex_search_service(query: str, service: str, limit: int, search_columns: Dict[str, str], use_reranker: bool = False) -> List[Dict[str, Any]]:
+    """
+    Execute a search against a specified Cortex Search service and format results.
+    """
+    
+    search_col = _resolve_search_column(service, search_columns)
+    if not search_col:
+        return []
+
+    columns = _result_columns(search_col)
     try:
-        resp = svc.search(
-            query=query,
-            columns=[
-                search_col,
-                'FILE_NAME',
-                'TITLE_VALUE',
-                'LAST_UPDATED_VALUE',
-                'APPLIES_TO_VALUE',
-                'SNOWFLAKE_FILE_URL'
-            ],
-            limit=limit
-        )
+        records = _cached_search(query, service, limit, tuple(columns.values()), use_reranker)
     except Exception as e:
         st.error(f"Search failed: {e}")
         return []
 
     # Format and return results list
     return [
-        {
-            "file": rec["FILE_NAME"],
-            "chunk": rec[search_col],
-            "title": rec["TITLE_VALUE"],
-            "last_updated": rec["LAST_UPDATED_VALUE"],
-            "applies_to": rec['APPLIES_TO_VALUE'],
-            "file_url":     rec["SNOWFLAKE_FILE_URL"]
-        }
-        for rec in resp.results
-    ]
\ No newline at end of file
+        {field: rec[col] for field, col in columns.items()}
+        for rec in records
+    ]
+
@@ -1,4 +1,7 @@
+import io
+import threading
 import streamlit as st
+import pypdfium2 as pdfium
 from snowflake.snowpark.context import get_active_session
 from snowflake.core import Root
 
@@ -13,4 +16,48 @@ def _init_snowflake():
     return sess, Root(sess)
 
 # Initialize session
-session, root = _init_snowflake()
\ No newline at end of file
+session, root = _init_snowflake()
+
+# The app's database and schema do not change for the lifetime of the session
+current_database = session.get_current_database()
+current_schema = session.get_current_schema()
+
+
+@st.cache_resource(show_spinner=False)
+def get_search_service(db: str, schema: str, service: str):
+    """
+    Resolve and cache the Cortex search service handle.
+    """
+    
+    return root.databases[db].schemas[schema].cortex_search_services[service]
+
+
+# pdfium is not thread-safe; documents below are shared across sessions
+pdfium_lock = threading.Lock()
+
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def get_pdf_document(stage_ref: str) -> pdfium.PdfDocument:
+    """
+    Download a PDF from a stage once and share the parsed document across sessions.
+    """
+    
+    raw_bytes = session.file.get_stream(stage_ref).read()
+    with pdfium_lock:
+        return pdfium.PdfDocument(raw_bytes)
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_pdf_thumbnail(stage_ref: str, page_no: int = 0, scale: int = 1) -> bytes:
+    """
+    Render a page of a staged PDF to JPEG bytes, cached so reruns skip pdfium.
+    """
+    
+    pdf = get_pdf_document(stage_ref)
+    with pdfium_lock:
+        page = pdf.get_page(page_no)
+        image = page.render(scale=scale).to_pil()
+        page.close()
+    buf = io.BytesIO()
+    image.convert("RGB").save(buf, "JPEG", quality=75, optimize=True)
+    return buf.getvalue()